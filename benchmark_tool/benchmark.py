@@ -1,140 +1,320 @@
+import argparse
 import subprocess
+import tempfile
 import time
 import sys
 import os
 import re
+import shlex
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
-try:
-    import tiktoken
+# Bounds on how much of a file the baseline reads, so tokenization cost tracks
+# what an agent would page in rather than the full file size.
+METHOD_BODY_LINES = 80
+MAX_READ_BYTES = 64 * 1024
+
+# Printed between fused shell steps, followed by a timestamp, so one bash
+# process can report per-step output and duration.
+STEP_SEP = "---SEP---"
+# Matches one separator line in raw script stdout; the group is the timestamp.
+_STEP_SEP_RE = re.compile(rb"\n" + re.escape(STEP_SEP.encode()) + rb" (\S+)\n")
+
+# Most bytes taken per read from a command's stdout pipe.
+READ_CHUNK = 64 * 1024
+
+# Project-wide search uses ripgrep when installed, otherwise plain grep -r.
+# --sort path keeps rg's output order (and so the first 20 lines) stable across
+# runs; --no-ignore --hidden searches the same files grep -r would.
+if shutil.which("rg"):
+    PROJECT_GREP = ["rg", "--sort", "path", "--no-ignore", "--hidden"]
+else:
+    PROJECT_GREP = ["grep", "-r"]
+
+def _stamp_ns(stamp):
+    """Parse a shell "<seconds>[.<fraction>]" timestamp (bytes) into integer nanoseconds."""
+    # EPOCHREALTIME uses the locale's decimal point.
+    secs, _, frac = stamp.replace(b",", b".").partition(b".")
+    return int(secs) * 1_000_000_000 + int(frac[:9].ljust(9, b"0"))
+
+def log(msg):
+    # A single write per message keeps lines intact when groups run in parallel threads.
+    sys.stdout.write(f"{msg}\n")
+
+# Set by load_tokenizer() when --exact-tokens is given; None means use the
+# ~4 bytes/token estimate, which is close for English text and code in cl100k.
+enc = None
+
+def load_tokenizer():
+    global enc
+    # tiktoken otherwise caches the cl100k_base table under a temp dir that fresh environments lose.
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.expanduser("~/.cache/tiktoken"))
+    try:
+        import tiktoken
+    except ImportError:
+        print("[System] tiktoken not found, using byte-length approximation (bytes / 4). Install with 'pip install tiktoken'.")
+        return
     enc = tiktoken.get_encoding("cl100k_base")
-    def count_tokens(text):
-        return len(enc.encode(text))
     print("[System] using tiktoken for counting.")
-except ImportError:
-    print("[System] tiktoken not found, using simple word count approximation (words * 1.3). Install with 'pip install tiktoken'.")
-    def count_tokens(text):
-        if not text: return 0
-        return int(len(text.split()) * 1.3)
+
+def estimate_tokens(text):
+    return len(text.encode("utf-8")) // 4
+
+def count_tokens_batch(texts):
+    if enc is None:
+        return [estimate_tokens(text) for text in texts]
+    # Steps often repeat output (e.g. the same error from every failed git-ai call),
+    # so each distinct text is encoded once.
+    # Empty output (e.g. a git-ai call that printed nothing) is exactly 0 tokens
+    # and needs no BPE pass.
+    unique = [text for text in dict.fromkeys(texts) if text]
+    # One FFI crossing for all outputs; tiktoken spreads the work over its thread pool.
+    encoded = enc.encode_ordinary_batch(unique, num_threads=os.cpu_count() or 1)
+    counts = {"": 0}
+    counts.update((text, len(ids)) for text, ids in zip(unique, encoded))
+    return [counts[text] for text in texts]
 
 class BenchmarkResult:
     def __init__(self, name):
         self.name = name
-        self.steps = []
-        self.total_tokens = 0
-        self.total_time = 0
-
-    def add_step(self, tool, command, output, duration):
-        tokens = count_tokens(output)
-        self.steps.append({
-            "tool": tool,
-            "command": command,
-            "tokens": tokens,
-            "duration": duration,
-            "output_len": len(output)
-        })
-        self.total_tokens += tokens
-        self.total_time += duration
-        print(f"[Step {len(self.steps)}] Tool: {tool}, Tokens: {tokens}, Time: {duration:.4f}s, OutputLen: {len(output)}")
+        # One list per field, indexed by step.
+        self.tools = []
+        self.commands = []
+        self.outputs = []
+        self.tokens = []
+        self.durations_ns = []
+        self.output_lens = []
+        # Longest of the group's concurrent branches, each the sum of its steps'
+        # net durations; set by add_branches. Excludes harness overhead such as
+        # thread startup and the fused script's stamps.
+        self.elapsed_ns = 0
+
+    @property
+    def total_tokens(self):
+        return sum(self.tokens)
+
+    @property
+    def total_time(self):
+        return self.elapsed_ns / 1e9
+
+    def add_step(self, tool, command, output, duration_ns):
+        self.tools.append(tool)
+        self.commands.append(command)
+        self.outputs.append(output)
+        self.durations_ns.append(duration_ns)
+        self.output_lens.append(len(output))
+        # self.tokens is filled in later by count_result_tokens, in one batch for all results.
+        log(f"[{self.name} Step {len(self.commands)}] Tool: {tool}, Time: {duration_ns / 1e9:.4f}s, OutputLen: {len(output)}")
+
+    def add_steps(self, captured):
+        for cmd_str, output, duration_ns in captured:
+            self.add_step(cmd_str.split()[0], cmd_str, output, duration_ns)
+
+    def add_branches(self, branches):
+        """Record branches that ran concurrently; each is a list of captures that ran in sequence."""
+        for captured in branches:
+            self.add_steps(captured)
+        self.elapsed_ns = max((sum(c[2] for c in captured) for captured in branches), default=0)
+
+def count_result_tokens(*results):
+    counts = count_tokens_batch([output for res in results for output in res.outputs])
+    start = 0
+    for res in results:
+        end = start + len(res.outputs)
+        res.tokens = counts[start:end]
+        start = end
 
 class Runner:
     def __init__(self, cwd):
         self.cwd = cwd
         print(f"[System] Target Directory: {self.cwd}")
 
-    def run_cmd(self, cmd_str, result_tracker):
-        print(f"Running: {cmd_str}")
-        start = time.time()
+    def _stream(self, args, max_lines=None):
+        """Run a command, reading stdout up to READ_CHUNK at a time; returns raw (stdout, stderr) bytes.
+
+        stderr goes to a temp file so a chatty stderr cannot fill its pipe and
+        stall the process while stdout is being drained. With max_lines, the
+        process is stopped once that many lines have been read, like `| head -n`.
+        """
+        buf = bytearray()
+        newlines = 0
+        with tempfile.TemporaryFile() as err:
+            proc = subprocess.Popen(args, cwd=self.cwd, stdout=subprocess.PIPE,
+                                    stderr=err, bufsize=READ_CHUNK)
+            with proc.stdout:
+                while True:
+                    # read1 returns whatever is available, so max_lines can stop the process
+                    # as soon as enough lines arrive instead of waiting for a full chunk.
+                    chunk = proc.stdout.read1(READ_CHUNK)
+                    if not chunk:
+                        break
+                    buf += chunk
+                    if max_lines is not None:
+                        newlines += chunk.count(b"\n")
+                        if newlines >= max_lines:
+                            proc.kill()
+                            break
+            proc.wait()
+            err.seek(0)
+            stderr = err.read()
+        if max_lines is not None:
+            buf = b"".join(buf.splitlines(keepends=True)[:max_lines])
+        return bytes(buf), stderr
+
+    def capture(self, argv, max_lines=None):
+        """Run one command from its argv, without a shell, and return (command, output, duration_ns)."""
+        cmd_str = shlex.join(argv)
+        log(f"Running: {cmd_str}")
+        start = time.perf_counter_ns()
         try:
             # Capture both stdout and stderr
-            res = subprocess.run(cmd_str, shell=True, cwd=self.cwd, capture_output=True, text=True)
-            output = res.stdout
-            if res.stderr:
-                output += "\n[STDERR]\n" + res.stderr
+            stdout, stderr = self._stream(argv, max_lines=max_lines)
+            output = stdout.decode("utf-8", errors="replace")
+            if stderr:
+                output += "\n[STDERR]\n" + stderr.decode("utf-8", errors="replace")
         except Exception as e:
             output = str(e)
         
-        duration = time.time() - start
-        tool_name = cmd_str.split()[0]
-        result_tracker.add_step(tool_name, cmd_str, output, duration)
-        return output
+        duration_ns = time.perf_counter_ns() - start
+        return cmd_str, output, duration_ns
+
+    def capture_all(self, argvs):
+        """Run independent commands concurrently, returning captures in the given order."""
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            return list(pool.map(self.capture, argvs))
+
+    def capture_script(self, steps):
+        """Run (command, glue) steps in a single bash process.
+
+        Each command's stdout, plus any stderr under a [STDERR] header as in
+        capture(), becomes that step's output. The optional glue runs after it
+        with stdout alone in $out, to set variables for later steps; anything
+        the glue writes to stderr is logged as a notice.
+        Returns one (command, output, duration_ns) capture per step, with the
+        command's shell variables expanded.
+        """
+        lines = [
+            # bash 5 has $EPOCHREALTIME; older bash (macOS /bin/bash 3.2) falls back
+            # to perl, which ships with macOS, for sub-second stamps.
+            "if [ -n \"${EPOCHREALTIME:-}\" ]; then",
+            f"  stamp() {{ printf '\\n%s %s\\n' '{STEP_SEP}' \"$EPOCHREALTIME\"; }}",
+            "elif command -v perl >/dev/null 2>&1; then",
+            f"  stamp() {{ printf '\\n%s ' '{STEP_SEP}'; perl -MTime::HiRes=time -e 'printf \"%.6f\\n\", time'; }}",
+            "else",
+            f"  stamp() {{ printf '\\n%s %s\\n' '{STEP_SEP}' \"$(date +%s)\"; }}",
+            "fi",
+            "errf=$(mktemp); trap 'rm -f \"$errf\"' EXIT",
+            # Two back-to-back stamps measure the cost of stamping itself, which
+            # is subtracted from every step (non-trivial when it forks perl).
+            "stamp",
+            "stamp",
+        ]
+        for cmd_str, glue in steps:
+            # Each section starts with the command as the shell expanded it.
+            quoted = cmd_str.replace("\\", "\\\\").replace('"', '\\"').replace("`", "\\`")
+            lines.append(f"printf '%s\\n' \"{quoted}\"")
+            lines.append(f"out=$( {{ {cmd_str}; }} 2>\"$errf\" ); printf '%s' \"$out\"")
+            lines.append("if [ -s \"$errf\" ]; then printf '\\n[STDERR]\\n'; cat \"$errf\"; : > \"$errf\"; fi")
+            if glue:
+                lines.append(glue)
+            lines.append("stamp")
+        script = "\n".join(lines)
+
+        try:
+            raw, notices = self._stream(["bash", "-c", script])
+        except Exception as e:
+            return [(cmd_str, str(e), 0) for cmd_str, _ in steps]
+        for notice in notices.decode("utf-8", errors="replace").splitlines():
+            log(notice)
+
+        # Split before decoding; split yields [prefix, ts0, "", ts1, out1, ts2, out2, ...]
+        parts = _STEP_SEP_RE.split(raw)
+        stamps = [_stamp_ns(ts) for ts in parts[1::2]]
+        sections = parts[2::2]
+        overhead_ns = stamps[1] - stamps[0] if len(stamps) > 1 else 0
+        captured = []
+        for i, (cmd_str, _) in enumerate(steps):
+            if i + 1 < len(sections):
+                resolved, _, body = sections[i + 1].partition(b"\n")
+                cmd_str = resolved.decode("utf-8", errors="replace")
+                step_output = body.decode("utf-8", errors="replace")
+            else:
+                step_output = ""
+            duration_ns = max(0, stamps[i + 2] - stamps[i + 1] - overhead_ns) if i + 2 < len(stamps) else 0
+            log(f"Ran: {cmd_str}")
+            captured.append((cmd_str, step_output, duration_ns))
+        return captured
 
 def run_baseline(runner):
-    print("\n==========================================")
-    print("  Starting Group A (Baseline: grep/ls/cat)")
-    print("==========================================")
+    log("\n==========================================\n"
+        "  Starting Group A (Baseline: grep/ls/cat)\n"
+        "==========================================")
     res = BenchmarkResult("Baseline (grep/cat)")
     
     # Task: Analyze SysUserServiceImpl.java selectUserList
-    
-    # 1. Locate the file
-    print(">>> Goal: Find 'SysUserServiceImpl.java'")
-    out1 = runner.run_cmd("find . -name SysUserServiceImpl.java", res)
-    paths = [line for line in out1.split('\n') if line.strip().endswith('SysUserServiceImpl.java')]
-    if not paths:
-        print("!! File not found, using default assumption.")
-        target_file = "ruoyi-system/src/main/java/com/ruoyi/system/service/impl/SysUserServiceImpl.java"
-    else:
-        target_file = paths[0].strip()
-    
-    # 2. Find definition of selectUserList
-    print(f">>> Goal: Find definition of 'selectUserList' in {target_file}")
-    out2 = runner.run_cmd(f"grep -n 'List<SysUser> selectUserList' {target_file}", res)
-    
-    line_num = 1
-    match = re.search(r'^(\d+):', out2)
-    if match:
-        line_num = int(match.group(1))
-    
-    # 3. Read the method body (Simulating reading the file to understand context)
-    print(f">>> Goal: Read file content {target_file}")
-    # Agents often read the whole file or large chunks. Using cat to simulate standard behavior.
-    runner.run_cmd(f"cat {target_file}", res)
-    
-    # 4. Find callers in the whole project
-    print(">>> Goal: Find callers of 'selectUserList' in project")
-    runner.run_cmd("grep -r 'selectUserList' . | head -n 20", res)
-    
-    # 5. Check one caller file context
-    # Assume we found SysUserController.java in previous output or we know it.
-    # Let's find a controller file in the grep output
+    # Steps 1-3 depend on each other and run in one bash process; later steps
+    # read $target and $line_num, which the glue derives from earlier outputs.
+    # Steps 4-5 are independent and run alongside.
+    default_target = "ruoyi-system/src/main/java/com/ruoyi/system/service/impl/SysUserServiceImpl.java"
+    # Assume we found SysUserController.java in the grep output or we know it.
     caller_file = "ruoyi-admin/src/main/java/com/ruoyi/web/controller/system/SysUserController.java"
-    print(f">>> Goal: Read caller context in {caller_file}")
-    runner.run_cmd(f"cat {caller_file}", res) # Reading full caller file
+    log(">>> Goal: Find 'SysUserServiceImpl.java', the definition of 'selectUserList',\n"
+        "          its method body, its callers, and one caller's context")
+    chain = [
+        # 1. Locate the file
+        ("find . -name SysUserServiceImpl.java",
+         # find only prints exact name matches, so take the first line as is.
+         f"target=${{out%%$'\\n'*}}; "
+         f"if [ -z \"$target\" ]; then echo '!! File not found, using default assumption.' >&2; target={default_target}; fi"),
+        # 2. Find definition of selectUserList
+        ("grep -n 'List<SysUser> selectUserList' \"$target\"",
+         # Parsed in bash itself: a forked pipeline here would be timed as grep.
+         "re='^([0-9]+):'; if [[ $out =~ $re ]]; then line_num=${BASH_REMATCH[1]}; else line_num=1; fi"),
+        # 3. Read a fixed window of the method body starting at the definition
+        (f"sed -n \"${{line_num}},$((line_num + {METHOD_BODY_LINES} - 1))p\" \"$target\"", None),
+    ]
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        chain_future = pool.submit(runner.capture_script, chain)
+        # 4. Find callers in the whole project
+        callers_future = pool.submit(runner.capture, PROJECT_GREP + ["selectUserList", "."], max_lines=20)
+        # 5. Check one caller file context, capped
+        context_future = pool.submit(runner.capture, ["head", "-c", str(MAX_READ_BYTES), caller_file])
+        res.add_branches([chain_future.result(), [callers_future.result()], [context_future.result()]])
     
     return res
 
 def run_git_ai(runner):
-    print("\n==========================================")
-    print("  Starting Group B (Experimental: git-ai)")
-    print("==========================================")
+    log("\n==========================================\n"
+        "  Starting Group B (Experimental: git-ai)\n"
+        "==========================================")
     res = BenchmarkResult("Experimental (git-ai)")
     
-    # 1. Search for symbol definition directly
-    print(">>> Goal: Find definition of 'selectUserList' in 'SysUserServiceImpl'")
-    # Using 'semantic' as 'find-def' proxy if precise symbol search isn't CLI exposed yet, 
-    # but 'query' is symbol search.
-    runner.run_cmd("git-ai ai query 'SysUserServiceImpl selectUserList'", res)
-    
-    # 2. Find usages/callers using Graph
-    print(">>> Goal: Find callers of 'selectUserList'")
-    runner.run_cmd("git-ai ai graph callers selectUserList", res)
-    
-    # 3. Analyze call chain
-    print(">>> Goal: Analyze call chain")
-    runner.run_cmd("git-ai ai graph chain selectUserList", res)
-    
-    # 4. Semantic search for logic summary
-    # Limit to top 2 results to simulate efficient retrieval
-    print(">>> Goal: Semantic search for logic summary")
-    runner.run_cmd("git-ai ai semantic 'How does selectUserList work in SysUserServiceImpl?' --topk 2", res)
+    # The four queries are independent, so they run concurrently.
+    log(">>> Goal: Find definition, callers, call chain and a logic summary of 'selectUserList'")
+    commands = [
+        # 1. Search for symbol definition directly
+        # Using 'semantic' as 'find-def' proxy if precise symbol search isn't CLI exposed yet, 
+        # but 'query' is symbol search.
+        ["git-ai", "ai", "query", "SysUserServiceImpl selectUserList"],
+        # 2. Find usages/callers using Graph
+        ["git-ai", "ai", "graph", "callers", "selectUserList"],
+        # 3. Analyze call chain
+        ["git-ai", "ai", "graph", "chain", "selectUserList"],
+        # 4. Semantic search for logic summary
+        # Limit to top 2 results to simulate efficient retrieval
+        ["git-ai", "ai", "semantic", "How does selectUserList work in SysUserServiceImpl?", "--topk", "2"],
+    ]
+    res.add_branches([[captured] for captured in runner.capture_all(commands)])
     
     return res
 
 def print_report(baseline, experimental):
-    print("\n\n")
-    print("######################################################")
-    print("#                  BENCHMARK REPORT                  #")
-    print("######################################################")
+    lines = [
+        "\n\n",
+        "######################################################",
+        "#                  BENCHMARK REPORT                  #",
+        "######################################################",
+    ]
     
     headers = ["Metric", "Baseline (grep/cat)", "Experimental (git-ai)", "Improvement"]
     
@@ -144,8 +324,8 @@ def print_report(baseline, experimental):
     diff_tok = (exp_tok - base_tok) / base_tok * 100 if base_tok > 0 else 0
     
     # Metric 2: Steps
-    base_steps = len(baseline.steps)
-    exp_steps = len(experimental.steps)
+    base_steps = len(baseline.commands)
+    exp_steps = len(experimental.commands)
     diff_steps = (exp_steps - base_steps) / base_steps * 100 if base_steps > 0 else 0
     
     # Metric 3: Context Density (Tokens per Step)
@@ -162,39 +342,57 @@ def print_report(baseline, experimental):
     # If git-ai is precise, this might be lower.
     diff_density = (exp_density - base_density) / base_density * 100 if base_density > 0 else 0
 
-    try:
-        from tabulate import tabulate
-        table = [
-            ["Total Search Tokens", f"{base_tok:,}", f"{exp_tok:,}", f"{diff_tok:.1f}%"],
-            ["Steps to Solution", str(base_steps), str(exp_steps), f"{diff_steps:.1f}%"],
-            ["Avg Tokens/Step", f"{base_density:.1f}", f"{exp_density:.1f}", f"{diff_density:.1f}%"],
-            ["Total Time (s)", f"{baseline.total_time:.2f}", f"{experimental.total_time:.2f}", f"{(experimental.total_time - baseline.total_time):.2f}s"]
-        ]
-        print(tabulate(table, headers=headers, tablefmt="github"))
-    except ImportError:
-        row_format = "{:<25} | {:<20} | {:<20} | {:<15}"
-        print(row_format.format(*headers))
-        print("-" * 90)
-        print(row_format.format("Total Search Tokens", f"{base_tok:,}", f"{exp_tok:,}", f"{diff_tok:.1f}%"))
-        print(row_format.format("Steps to Solution", str(base_steps), str(exp_steps), f"{diff_steps:.1f}%"))
-        print(row_format.format("Avg Tokens/Step", f"{base_density:.1f}", f"{exp_density:.1f}", f"{diff_density:.1f}%"))
-        print(row_format.format("Total Time (s)", f"{baseline.total_time:.2f}", f"{experimental.total_time:.2f}", f"{(experimental.total_time - baseline.total_time):.2f}s"))
+    # Without tiktoken the token rows are bytes / 4 estimates; say so in the report itself.
+    est = "" if enc is not None else " (est.)"
+    table = [
+        headers,
+        [f"Total Search Tokens{est}", f"{base_tok:,}", f"{exp_tok:,}", f"{diff_tok:.1f}%"],
+        ["Steps to Solution", str(base_steps), str(exp_steps), f"{diff_steps:.1f}%"],
+        [f"Avg Tokens/Step{est}", f"{base_density:.1f}", f"{exp_density:.1f}", f"{diff_density:.1f}%"],
+        ["Total Time (s)", f"{baseline.total_time:.2f}", f"{experimental.total_time:.2f}", f"{(experimental.total_time - baseline.total_time):.2f}s"]
+    ]
+    # Per-step breakdown, read straight from each result's per-field lists.
+    lines.append(f"{'Group':<22} | {'Step':<4} | {'Tool':<8} | {'Tokens' + est:<13} | {'Time (s)':<8} | Output Len")
+    lines.append("-" * 82)
+    for res in (baseline, experimental):
+        for i, (tool, tokens, duration_ns, output_len) in enumerate(
+                zip(res.tools, res.tokens, res.durations_ns, res.output_lens), 1):
+            lines.append(f"{res.name:<22} | {i:<4} | {tool:<8} | {tokens:<13,} | {duration_ns / 1e9:<8.4f} | {output_len:,}")
+    lines.append("")
+
+    # The layout is fixed, so fixed column widths are enough.
+    rows = [f"{metric:<27} | {base:<20} | {exp:<22} | {diff:<15}" for metric, base, exp, diff in table]
+    rows.insert(1, "-" * 94)
+    lines.extend(rows)
+    lines.append(f"Project search: {shlex.join(PROJECT_GREP)}")
+    if est:
+        lines.append("(est.) = UTF-8 bytes / 4, not cl100k counts; pass --exact-tokens for exact numbers.")
+    sys.stdout.write("\n".join(lines) + "\n")
 
 if __name__ == "__main__":
-    target_dir = "/Users/mars/dev/ruoyi"
-    if len(sys.argv) > 1:
-        target_dir = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Compare token cost of grep/cat against git-ai.")
+    parser.add_argument("target_dir", nargs="?", default="/Users/mars/dev/ruoyi")
+    parser.add_argument("--exact-tokens", action="store_true",
+                        help="count tokens with tiktoken (cl100k_base) instead of estimating bytes / 4")
+    args = parser.parse_args()
+    target_dir = args.target_dir
     
     if not os.path.exists(target_dir):
         print(f"Error: Target directory {target_dir} does not exist.")
         sys.exit(1)
         
+    if args.exact_tokens:
+        load_tokenizer()
+    else:
+        print("[System] estimating tokens as bytes / 4. Pass --exact-tokens to count with tiktoken.")
     runner = Runner(target_dir)
     
     # Ensure git-ai is ready (optional check)
     # subprocess.run("git-ai ai index", shell=True, cwd=target_dir) 
     
+    # Groups run one after the other so neither one's load skews the other's timings.
     base_res = run_baseline(runner)
     exp_res = run_git_ai(runner)
+    count_result_tokens(base_res, exp_res)
     
     print_report(base_res, exp_res)